@@ -4,9 +4,24 @@ import os
 import re
 import json
 import argparse
-import requests
+import orjson
+import functools
+import itertools
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+# Tautulli metadata rarely changes between runs, while the *arr libraries change whenever media is added or deleted.
+# Library responses are revalidated on every run with If-None-Match/If-Modified-Since, so an unchanged library
+# comes back as a bodyless 304 and is served from the cache.
+METADATA_CACHE_TTL = timedelta(days=7)
+LIBRARY_CACHE_TTL = requests_cache.EXPIRE_IMMEDIATELY
+
+# Years and punctuation are stripped from titles before fuzzy matching
+CLEAN_TITLE_RE = re.compile(r'\b\d{4}\b|[^\w\s]')
+
 
 class WatchStatusChecker:
     def __init__(self):
@@ -26,8 +41,12 @@ class WatchStatusChecker:
                             help="Hostname or IP address of your Radarr server")
         parser.add_argument("--radarr-token", default=config["radarr_token"],
                             help="Radarr API token")
+        parser.add_argument("--max-workers", type=int, default=config.get("max_workers", 5),
+                            help="Number of concurrent Tautulli metadata requests")
         self.docker = config["DOCKER"]
         self.args = parser.parse_args()
+        if self.args.max_workers < 1:
+            parser.error("--max-workers must be at least 1")
 
         self.print_timestamp_if_docker()
         print("Starting Check")
@@ -39,9 +58,50 @@ class WatchStatusChecker:
                   "tautulli-host, tautulli-token, sonarr-host, sonarr-token, radarr-host, radarr-token")
             exit(1)
 
-        self.tautulli_headers = {'apikey': self.args.tautulli_host}
         self.unwatched_media = []
 
+        # One session per service so each keeps its own keep-alive pool and default headers,
+        # all sharing a single on-disk cache
+        cache = requests_cache.SQLiteCache('find_unwatched_media_cache')
+        # Drop anything cached longer ago than the metadata TTL, otherwise rows for rating keys that are never
+        # requested again stay forever. Age is used rather than expired=True because library responses are
+        # stored already expired so they can be revalidated.
+        cache.delete(older_than=METADATA_CACHE_TTL)
+        # At least two connections, since both Tautulli sections are fetched together during setup
+        self._tautulli_session = self._build_session(cache, pool_maxsize=max(self.args.max_workers, 2),
+                                                     filter_fn=self._is_cacheable_tautulli_response)
+        self._tautulli_session.params = {'apikey': self.args.tautulli_token}
+        self._sonarr_session = self._build_session(cache)
+        self._sonarr_session.headers.update({"X-Api-Key": self.args.sonarr_token})
+        self._radarr_session = self._build_session(cache)
+        self._radarr_session.headers.update({"X-Api-Key": self.args.radarr_token})
+
+    @staticmethod
+    def _build_session(cache, pool_maxsize=4, **cache_settings):
+        # Reuse keep-alive connections instead of reconnecting per request. Each session only talks to one
+        # host, and the pool is sized to its peak concurrency so every concurrent request gets a warm connection.
+        # Nothing is cached unless a request opts in with its own expire_after.
+        session = requests_cache.CachedSession(backend=cache,
+                                               expire_after=requests_cache.DO_NOT_CACHE,
+                                               ignored_parameters=['apikey', 'X-Api-Key'],
+                                               **cache_settings)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize,
+                              max_retries=Retry(total=3, backoff_factor=0.3,
+                                                status_forcelist=[429, 500, 502, 503, 504]))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    @staticmethod
+    def _is_cacheable_tautulli_response(response):
+        # Tautulli answers HTTP 200 for errors and returns empty data while Plex is unreachable,
+        # so only keep responses that actually carry a result
+        try:
+            body = response.json()["response"]
+        except (ValueError, KeyError, TypeError):
+            return False
+        return body.get("result") == "success" and bool(body.get("data"))
+
     def print_timestamp_if_docker(self):
         if self.docker:
             print(f"{datetime.now()}: ", end="")
@@ -49,85 +109,119 @@ class WatchStatusChecker:
     def get_tautulli_data(self, section_id):
         # Fetch media info from Tautulli library
         params = {
-            'apikey': self.args.tautulli_token,
             'cmd': 'get_library_media_info',
             'section_id': section_id,
             'length': 5000  # Adjust this to the maximum number of items you want to retrieve
         }
-        response = requests.get(f"{self.args.tautulli_host}/api/v2", params=params)
+        response = self._tautulli_session.get(f"{self.args.tautulli_host}/api/v2", params=params)
         return response.json()["response"]
 
     def get_unwatched_media(self):
-        self._grab_content_library()
-
         # Pass 1 for movies and 2 for TV shows
         movie_section_id = 1
         tv_show_section_id = 2
 
-        # Fetch movie media info from Tautulli
-        movie_data = self.get_tautulli_data(movie_section_id)["data"]["data"]
-        # Fetch TV show media info from Tautulli
-        tv_show_data = self.get_tautulli_data(tv_show_section_id)["data"]["data"]
-        all_media_data = movie_data + tv_show_data
-
-        two_months_ago = datetime.now() - timedelta(days=60)  # Assuming 2 months = 60 days
-        all_media_data = [item for item in all_media_data if datetime.fromtimestamp(int(item['added_at'])) <= two_months_ago]
-
-        for media in all_media_data:
-            if media['last_played'] is None or int(media['last_played']) == 0:
-                arr_info, media_type = self.get_arr_info(media["rating_key"])
-                if not arr_info:
-                    continue
-                if "(Do Not Delete)" not in arr_info["path"]:
-                    if media_type == "show":
-                        url = f"{self.args.sonarr_host}/series/{arr_info["titleSlug"]}"
-                    else:
-                        url = f"{self.args.radarr_host}/movie/{arr_info["titleSlug"]}"
-                    self.unwatched_media.append(
-                        {"title": media["title"], "path": arr_info["path"],
-                         "id": arr_info["id"], "type": media_type, "url": url, "year": arr_info["year"]})
+        # The Tautulli sections and the *arr libraries are independent, so fetch all four at once
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {
+                'movies': executor.submit(self.get_tautulli_data, movie_section_id),
+                'tv': executor.submit(self.get_tautulli_data, tv_show_section_id),
+                'sonarr': executor.submit(self._fetch_sonarr),
+                'radarr': executor.submit(self._fetch_radarr),
+            }
+        self._set_content_libraries(futures['sonarr'].result(), futures['radarr'].result())
+
+        movie_data = futures['movies'].result()["data"]["data"]
+        tv_show_data = futures['tv'].result()["data"]["data"]
+
+        two_months_ago = int((datetime.now() - timedelta(days=60)).timestamp())  # Assuming 2 months = 60 days
+        # Keyed by rating_key so an item that appears more than once is only looked up once
+        candidates = {media['rating_key']: media for media in itertools.chain(movie_data, tv_show_data)
+                      if int(media['added_at']) <= two_months_ago
+                      and (media['last_played'] is None or int(media['last_played']) == 0)}
+
+        # Metadata lookups are network bound, so fan them out over a small pool to stay polite to Tautulli
+        with ThreadPoolExecutor(max_workers=self.args.max_workers) as executor:
+            futures = [(media, executor.submit(self.get_arr_info, media["rating_key"]))
+                       for media in candidates.values()]
+
+        for media, future in futures:
+            # A single failed lookup shouldn't throw away the rest of the batch
+            if future.exception():
+                print(f"Failed to look up {media["title"]}: {future.exception()}")
+                continue
+            arr_info, media_type = future.result()
+            if not arr_info:
+                continue
+            if "(Do Not Delete)" not in arr_info["path"]:
+                if media_type == "show":
+                    url = f"{self.args.sonarr_host}/series/{arr_info["titleSlug"]}"
+                else:
+                    url = f"{self.args.radarr_host}/movie/{arr_info["titleSlug"]}"
+                self.unwatched_media.append(
+                    {"title": media["title"], "path": arr_info["path"],
+                     "id": arr_info["id"], "type": media_type, "url": url, "year": arr_info["year"]})
 
     def get_arr_info(self, tautulli_rating_key):
         params = {
-            'apikey': self.args.tautulli_token,
             'cmd': 'get_metadata',
             'rating_key': tautulli_rating_key
         }
-        tautulli_media_metadata = requests.get(f"{self.args.tautulli_host}/api/v2", params=params).json()
+        tautulli_media_metadata = self._tautulli_session.get(f"{self.args.tautulli_host}/api/v2", params=params,
+                                                             expire_after=METADATA_CACHE_TTL).json()
         tautulli_media_metadata = tautulli_media_metadata["response"]["data"]
         if not tautulli_media_metadata:
             print(f"No item found for rating key: {tautulli_rating_key}")
             return None, None
-        guids_ids = [guid.split('//')[1] for guid in tautulli_media_metadata["guids"]]
+        # Keep the source with each id so e.g. a tmdb id can't match a tvdb id that happens to be equal
+        guids_ids = [tuple(guid.split('://', 1)) for guid in tautulli_media_metadata["guids"]]
+        media_type = tautulli_media_metadata["media_type"]
 
-        if tautulli_media_metadata["media_type"] == "show":
-            library = self._tv_library
-        elif tautulli_media_metadata["media_type"] == "movie":
-            library = self._movie_library
+        if media_type == "show":
+            guid_index, title_index = self._tv_by_guid, self._tv_by_clean_title
+        elif media_type == "movie":
+            guid_index, title_index = self._movie_by_guid, self._movie_by_clean_title
         else:
-            print(f"Invalid media type: {tautulli_media_metadata["media_type"]}")
-            exit(1)
+            print(f"Invalid media type: {media_type}")
+            return None, None
 
-        fuzzy_title_match = None
-        for media in library:
-            if self.clean_title(media["title"]) == self.clean_title(tautulli_media_metadata["title"]):
-                fuzzy_title_match = media
-            for key in ["imdbId", "tmdbId", "tvdbId"]:
-                if media.get(key) in guids_ids:
-                    return media, tautulli_media_metadata["media_type"]
+        for guid_id in guids_ids:
+            if guid_id in guid_index:
+                return guid_index[guid_id], media_type
 
+        fuzzy_title_match = title_index.get(self.clean_title(tautulli_media_metadata["title"]))
         if fuzzy_title_match:
             print(f"Fuzzy title search match for: {tautulli_media_metadata["title"]}")
-            return fuzzy_title_match, tautulli_media_metadata["media_type"]
+            return fuzzy_title_match, media_type
         else:
             print(f"No match found for: {tautulli_media_metadata["title"]}")
             return None, None
 
-    def _grab_content_library(self):
-        series_request = f"{self.args.sonarr_host}/api/v3/series/?apikey={self.args.sonarr_token}"
-        self._tv_library = json.loads(requests.get(series_request).text)
-        movies_request = f"{self.args.radarr_host}/api/v3/movie/?apikey={self.args.radarr_token}"
-        self._movie_library = json.loads(requests.get(movies_request).text)
+    def _fetch_sonarr(self):
+        series_request = f"{self.args.sonarr_host}/api/v3/series/"
+        # Library dumps can run to several MB, so let orjson parse the raw bytes
+        return orjson.loads(self._sonarr_session.get(series_request, expire_after=LIBRARY_CACHE_TTL).content)
+
+    def _fetch_radarr(self):
+        movies_request = f"{self.args.radarr_host}/api/v3/movie/"
+        return orjson.loads(self._radarr_session.get(movies_request, expire_after=LIBRARY_CACHE_TTL).content)
+
+    def _set_content_libraries(self, tv_library, movie_library):
+        self._tv_library = tv_library
+        self._movie_library = movie_library
+
+        self._tv_by_guid, self._tv_by_clean_title = self._index_library(self._tv_library)
+        self._movie_by_guid, self._movie_by_clean_title = self._index_library(self._movie_library)
+
+    def _index_library(self, library):
+        # Map every (source, external id) pair and cleaned title to its library item so lookups don't rescan the library
+        by_guid = {}
+        for media in library:
+            for source, key in [("imdb", "imdbId"), ("tmdb", "tmdbId"), ("tvdb", "tvdbId")]:
+                if media.get(key):
+                    by_guid.setdefault((source, str(media[key])), media)
+        by_clean_title = {self.clean_title(media["title"]): media for media in library}
+        return by_guid, by_clean_title
 
     def notify_discrepancies(self):
         if self.unwatched_media:
@@ -141,24 +235,37 @@ class WatchStatusChecker:
         print("Done!\n")
 
     def delete_media(self):
+        # Ask about everything up front so the prompts aren't held up by the deletes themselves
+        to_delete = []
         counter = 1
         for media in self.unwatched_media:
             if input(f"({counter}/{len(self.unwatched_media)}) {media["title"]} {media["year"]}: {media["url"]} (y/n) - ").lower() == "y":
-                if media["type"] == "show":
-                    delete_url = f"{self.args.sonarr_host}/api/v3/series/{media["id"]}?apikey={self.args.sonarr_token}&deleteFiles=true"
-                else:
-                    delete_url = f"{self.args.radarr_host}/api/v3/movie/{media["id"]}?apikey={self.args.radarr_token}&deleteFiles=true"
-                response = requests.delete(delete_url)
-                if response.status_code == 200:
-                    print(f"Deleted {media["title"]}")
-                else:
-                    print(f"Failed to delete {media["title"]}")
+                to_delete.append(media)
             counter += 1
 
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(self._issue_delete, media) for media in to_delete]
+
+        for media, future in zip(to_delete, futures):
+            if future.exception():
+                print(f"Failed to delete {media["title"]}: {future.exception()}")
+            elif future.result().status_code == 200:
+                print(f"Deleted {media["title"]}")
+            else:
+                print(f"Failed to delete {media["title"]}: HTTP {future.result().status_code}")
+
+    def _issue_delete(self, media):
+        if media["type"] == "show":
+            session, delete_url = self._sonarr_session, f"{self.args.sonarr_host}/api/v3/series/{media["id"]}"
+        else:
+            session, delete_url = self._radarr_session, f"{self.args.radarr_host}/api/v3/movie/{media["id"]}"
+        return session.delete(delete_url, params={'deleteFiles': 'true'})
+
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def clean_title(title):
         # Remove years and punctuation
-        cleaned_title = re.sub(r'\b\d{4}\b|[^\w\s]', '', title)
+        cleaned_title = CLEAN_TITLE_RE.sub('', title)
         return cleaned_title.strip()
 
 
@@ -167,8 +274,9 @@ if __name__ == '__main__':
     if not os.path.exists("unwatched_media.json") or input(f"Skip refresh? (y/n) ").lower() == "n":
         watch_checker.get_unwatched_media()
         watch_checker.notify_discrepancies()
-        with open('unwatched_media.json', 'w') as f:
-            json.dump(watch_checker.unwatched_media, f)
-    with open('unwatched_media.json') as f:
-        watch_checker.unwatched_media = json.load(f)
+        with open('unwatched_media.json', 'wb') as f:
+            f.write(orjson.dumps(watch_checker.unwatched_media))
+    else:
+        with open('unwatched_media.json', 'rb') as f:
+            watch_checker.unwatched_media = orjson.loads(f.read())
     watch_checker.delete_media()